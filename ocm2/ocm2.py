@@ -1,8 +1,13 @@
 import os, re, shutil, math
 import numpy as np
+from functools import partial, lru_cache
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     import rasterio
+    from rasterio.windows import Window
+    from rasterio.control import GroundControlPoint
 except ImportError:
     raise ImportError("`rasterio` is required for reading the file. Please install it using 'pip install rasterio' or 'conda install -c conda-forge rasterio'")
 
@@ -11,9 +16,241 @@ try:
 except ImportError:
     raise ImportError("`gdal` is required for reading the file. Please install it using 'pip install gdal' or 'conda install -c conda-forge gdal'")
 
+# `numba` and `numexpr` are optional. Without them the band arithmetic falls back to NumPy.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+# Mean solar exo-atmospheric irradiance of OCM-2 bands 1-8.
+ESOL = np.array([1.72815, 1.85211, 1.9721, 1.86697, 1.82781, 1.65765, 1.2897, 0.952073])
+
+# Band number of a layer file, e.g. 'band3.TIF' or 'band3_georef.TIF'.
+_BAND_RE = re.compile(r'band(\d+)', re.I)
+
+# Bands are independent files, so they are processed in parallel. Datasets are opened inside the workers.
+_MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def _init_worker(workers = _MAX_WORKERS):
+
+    """
+    This function initializes a worker process. GDAL errors are raised as exceptions so that a failed band stops the run
+    instead of silently producing a broken file. The pool already runs one band per core, so GDAL, numba and numexpr are
+    single-threaded inside a worker. For numba this is the serial build of the kernel, which never starts a threading
+    layer. GDAL's default block cache is split between the `workers` processes, and each worker copies in swaths as
+    large as its share, unless these are already set in the environment.
+    """
+
+    global _toa_kernel
+    
+    gdal.UseExceptions()
+    gdal.SetConfigOption('GDAL_NUM_THREADS', '1')
+    _toa_kernel = _toa_kernel_serial
+    if ne is not None:
+        ne.set_num_threads(1)
+    
+    if gdal.GetConfigOption('GDAL_CACHEMAX') is None:
+        gdal.SetCacheMax(gdal.GetCacheMax() // workers)
+    if gdal.GetConfigOption('GDAL_SWATH_SIZE') is None:
+        gdal.SetConfigOption('GDAL_SWATH_SIZE', str(gdal.GetCacheMax()))
+
+def _map(func, iterables, workers = None):
+
+    """
+    This function runs `func` over the bands in a process pool.
+    On Windows and macOS, and with Python 3.14+ everywhere, the pool starts its workers by importing the calling script,
+    so a script must call the pipeline under `if __name__ == '__main__':`. With `workers = 1` no pool is started.
+
+    Parameters:
+        func (function): Function to run, called with one item of each iterable.
+        iterables (list): Iterables of the arguments of `func`.
+        workers (int): Number of worker processes. 1 runs `func` in this process. Default is None, `_MAX_WORKERS`.
+
+    Returns:
+        results (list): Return values of `func`, in order.
+
+    """
+
+    if workers == 1:
+        return list(map(func, *iterables))
+    
+    workers = workers or _MAX_WORKERS
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (workers,)) as ex:
+        return list(ex.map(func, *iterables))
+
+def _gtiff_options(compress = 'ZSTD', dtype = gdal.GDT_Float32):
+
+    """
+    This function returns the GeoTIFF creation options used for all the output files.
+
+    Parameters:
+        compress (str): Compression codec. One of 'ZSTD', 'DEFLATE' or 'LZW'. Default is 'ZSTD'.
+        dtype (int): GDAL data type of the output. Selects the floating point (3) or the integer (2) predictor.
+
+    Returns:
+        options (list): List of GDAL GTiff creation options.
+
+    """
+
+    compress = compress.upper()
+    predictor = 3 if 'Float' in gdal.GetDataTypeName(dtype) else 2
+    options = ['COMPRESS={0}'.format(compress), 'PREDICTOR={0}'.format(predictor)]
+    if compress == 'ZSTD':
+        options.append('ZSTD_LEVEL=1')
+    # Pool workers set GDAL_NUM_THREADS to 1, see `_init_worker`.
+    num_threads = gdal.GetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    options += ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'NUM_THREADS={0}'.format(num_threads), 'BIGTIFF=IF_SAFER']
+
+    return options
+
+
+def _rio_options():
+
+    """
+    This function returns the rasterio profile entries of the float32 reflectance GeoTIFF files, the same creation
+    options as `_gtiff_options` with the ZSTD codec.
+
+    Returns:
+        options (dict): Profile entries for `profile.update`.
+
+    """
+
+    num_threads = gdal.GetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    return dict(dtype = 'float32', compress = 'zstd', predictor = 3, zstd_level = 1, tiled = True,
+                blockxsize = 512, blockysize = 512, num_threads = num_threads, bigtiff = 'IF_SAFER')
+
+
+def _tiles(width, height, size = 512):
+
+    """
+    This function yields the windows of a raster in tiles of `size` x `size` pixels.
+
+    Parameters:
+        width (int): Width of the raster.
+        height (int): Height of the raster.
+        size (int): Tile size. Default is 512, the block size of the output GeoTIFF files.
+
+    Returns:
+        (xoff, yoff, xsize, ysize) (tuple): Window of each tile.
+
+    """
+
+    for yoff in range(0, height, size):
+        for xoff in range(0, width, size):
+            yield xoff, yoff, min(size, width - xoff), min(size, height - yoff)
+
+
+def _band_no(name):
+
+    """
+    This function parses the band number from the name of a layer file, e.g. 3 for 'band3_georef.TIF'.
+
+    Parameters:
+        name (str): Name or path of the file.
+
+    Returns:
+        band_no (int): Band number. None if the name does not contain one.
+
+    """
 
+    match = _BAND_RE.search(os.path.basename(name))
+    return int(match.group(1)) if match else None
 
-def ExportSubdatasets(path, hdf_file):
+
+def _list_bands(folder):
+
+    """
+    This function scans a folder once and returns its band files sorted by band number.
+
+    Parameters:
+        folder (str): Path to the folder containing the GeoTiff files.
+
+    Returns:
+        bands (list): List of (band number, file name) tuples.
+
+    """
+
+    bands = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            band_no = _band_no(entry.name)
+            if band_no is not None and entry.name.lower().endswith(('.tif', '.img')):
+                bands.append((band_no, entry.name))
+
+    return sorted(bands)
+
+
+def _build_vrt(vrt_path, band_files):
+
+    """
+    This function stacks single-band GeoTIFF files into one virtual dataset (VRT).
+    Files with a different size than the first one are skipped. GCPs of the first file are kept.
+
+    Parameters:
+        vrt_path (str): Path of the output VRT file. Must be in the same folder as the band files.
+        band_files (list): List of paths of the GeoTIFF files, one VRT band each.
+
+    Returns:
+        vrt_path (str): Path of the output VRT file.
+
+    """
+
+    first = gdal.Open(band_files[0])
+    vrt = gdal.GetDriverByName('VRT').Create(vrt_path, first.RasterXSize, first.RasterYSize, 0)
+    if first.GetGCPCount():
+        vrt.SetGCPs(first.GetGCPs(), first.GetGCPProjection())
+    
+    source = ('<SimpleSource><SourceFilename relativeToVRT="1">{0}</SourceFilename>'
+              '<SourceBand>1</SourceBand></SimpleSource>')
+    for band_file in band_files:
+        src = gdal.Open(band_file)
+        if (src.RasterXSize, src.RasterYSize) != (first.RasterXSize, first.RasterYSize):
+            continue
+        vrt.AddBand(src.GetRasterBand(1).DataType)
+        vrt.GetRasterBand(vrt.RasterCount).SetMetadataItem('source_0', source.format(os.path.basename(band_file)), 'new_vrt_sources')
+        src = None
+    vrt = None
+    
+    return vrt_path
+
+
+def _export_subdataset(subdataset_name, band_path, compress = 'ZSTD', as_float = False):
+
+    """
+    This function exports a single HDF subdataset to GeoTIFF. Worker of `ExportSubdatasets`.
+
+    Parameters:
+        subdataset_name (str): GDAL name of the subdataset.
+        band_path (str): Path of the output GeoTIFF file.
+        compress (str): Compression codec of the GeoTIFF file.
+        as_float (bool): If True, the layer is promoted to Float32.
+
+    Returns:
+        band_path (str): Path of the output GeoTIFF file.
+
+    """
+
+    band_ds = gdal.Open(subdataset_name, gdal.GA_ReadOnly)
+    dtype = gdal.GDT_Float32 if as_float else band_ds.GetRasterBand(1).DataType
+    nodata = band_ds.GetRasterBand(1).GetNoDataValue()
+    
+    gdal.Translate(band_path, band_ds, format = 'GTiff',
+                   bandList = list(range(1, band_ds.RasterCount + 1)),
+                   outputType = dtype,
+                   noData = nodata,
+                   creationOptions = _gtiff_options(compress, dtype))
+    band_ds = None
+    
+    return band_path
+
+
+def ExportSubdatasets(path, hdf_file, compress = 'ZSTD', as_float = False, workers = None):
 
     """   
     This function takes the folder path and the HDF file as input and exports individual layers to TIFF (named GeoTIFF)
@@ -21,9 +258,12 @@ def ExportSubdatasets(path, hdf_file):
     Parameters:
         path (str): Path to the folder containing the HDF file.
         hdf_file (str): Name of the HDF file.
+        compress (str): Compression codec of the GeoTIFF files. One of 'ZSTD', 'DEFLATE' or 'LZW'. Default is 'ZSTD'.
+        as_float (bool): If True, the layers are promoted to Float32. Otherwise the native data type of the subdataset is kept. Default is False.
+        workers (int): Number of worker processes. 1 exports the layers in this process. See `_map`. Default is None.
 
     Returns:
-        opf_tif (str): Path to the folder containing the GeoTiff files.
+        opf_tif (str): Path to the folder containing the GeoTiff files and `scene.vrt`, a virtual stack of all the layers.
         
     """
     opf_tif = os.path.join(path, 'GeoTiff')
@@ -35,31 +275,12 @@ def ExportSubdatasets(path, hdf_file):
     hdf_ds = gdal.Open(inp_hdf, gdal.GA_ReadOnly)
     subdatasets = hdf_ds.GetSubDatasets()
     
-    for i in range(0, len(subdatasets)):
-        subdataset_name = subdatasets[i][0]
-        band_ds = gdal.Open(subdataset_name, gdal.GA_ReadOnly)
-        band_path = os.path.join(opf_tif, 'band{0}.TIF'.format(i))
-        if band_ds.RasterCount > 1:
-            for j in range(1,band_ds.RasterCount + 1):
-                band = band_ds.GetRasterBand(j)
-                band_array = band.ReadAsArray()
-        else:
-            band_array = band_ds.ReadAsArray()
-        
-        out_ds = gdal.GetDriverByName('GTiff').Create(band_path,
-                                                      band_ds.RasterXSize,
-                                                      band_ds.RasterYSize,
-                                                      1,
-                                                      gdal.GDT_Float64,
-                                                      ['COMPRESS=LZW', 'TILED=YES'])
-        
-        
-        out_ds.SetGeoTransform(band_ds.GetGeoTransform())
-        out_ds.SetProjection(band_ds.GetProjection())
-        out_ds.GetRasterBand(1).WriteArray(band_array)
-        out_ds.GetRasterBand(1).SetNoDataValue(-32768)
-        
-    out_ds = None
+    band_paths = [os.path.join(opf_tif, 'band{0}.TIF'.format(i)) for i in range(0, len(subdatasets))]
+    hdf_ds = None
+    
+    _map(partial(_export_subdataset, compress = compress, as_float = as_float),
+         ([sd[0] for sd in subdatasets], band_paths), workers)
+    _build_vrt(os.path.join(opf_tif, 'scene.vrt'), band_paths)
         
     return opf_tif
     
@@ -112,7 +333,54 @@ def GetExtent(ds):
     return (xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)
 
 
-def Georeference(inpf, gtif, meta, opf_ref):
+def _gcps(shape, meta):
+
+    """
+    This function returns the four corner GCPs of a raster using the metadata of the HDF file.
+
+    Parameters:
+        shape (tuple): (width, height) of the raster in pixels.
+        meta (list): List containing the metadata of the HDF file.
+
+    Returns:
+        gcps (list): List of `gdal.GCP` objects.
+
+    """
+    
+    width, height = shape
+    
+    '''
+    Enter the GCPs
+    Format: [map x-coordinate(longitude)], [map y-coordinate (latitude)], [elevation],
+    [image column index(x)], [image row index (y)]
+    The image positions are the pixel corners of the raster: upper left, upper right, lower right, lower left.
+    
+    '''
+    
+    pos = [(0, 0), (width, 0), (width, height), (0, height)]
+    gcps = [gdal.GCP(meta[i][0], meta[i][1], 0, pos[i][0], pos[i][1]) for i in range(4)]
+    
+    return gcps
+
+
+def _rio_gcps(shape, meta):
+
+    """
+    This function returns the four corner GCPs of a raster as rasterio ground control points.
+
+    Parameters:
+        shape (tuple): (width, height) of the raster in pixels.
+        meta (list): List containing the metadata of the HDF file.
+
+    Returns:
+        gcps (list): List of `rasterio.control.GroundControlPoint` objects.
+
+    """
+
+    return [GroundControlPoint(row = g.GCPLine, col = g.GCPPixel, x = g.GCPX, y = g.GCPY, z = g.GCPZ) for g in _gcps(shape, meta)]
+
+
+def Georeference(inpf, gtif, meta, opf_ref, sidecar = False, vrt = False):
 
     """
     This function georeferences the GeoTiff files using the metadata of the HDF file.
@@ -121,6 +389,10 @@ def Georeference(inpf, gtif, meta, opf_ref):
         inpf (str): Path to the folder containing the GeoTiff files.
         gtif (str): Name of the GeoTiff file.
         meta (dict): Dictionary containing the metadata of the HDF file.
+        sidecar (bool): If True, the output is a hard link to the input (a copy if linking is not possible) and the GCPs
+            are written to its `.aux.xml` sidecar, so no pixel data is read or written. Default is False.
+        vrt (bool): If True, the output is `<name>_georef.vrt`, a virtual dataset that carries the GCPs and reads the pixels
+            from the input file, so no pixel data is copied. The input file must be kept. Default is False.
 
     Returns:
         opf_ref (str): Path to the folder containing the georeferenced GeoTiff files.
@@ -128,106 +400,204 @@ def Georeference(inpf, gtif, meta, opf_ref):
     """
     
     inp_file = os.path.join(inpf, gtif)
-    band_tif = gdal.Open(inp_file)
-    ext = GetExtent(band_tif)
-    
-    ext_pos = [(abs(val[0]), abs(val[1])) for val in ext]
-
     out_file = os.path.join(opf_ref, os.path.basename(gtif).split('.')[0] + '_georef.TIF')
-    shutil.copy(inp_file, out_file)
-    ds = gdal.Open(out_file, gdal.GA_Update)
-    sr = osr.SpatialReference()
-    sr.ImportFromEPSG(4326) 
     
+    if sidecar:
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        try:
+            os.link(inp_file, out_file)
+        except OSError:
+            shutil.copy(inp_file, out_file)
+        
+        pam = gdal.GetConfigOption('GDAL_PAM_ENABLED')
+        gdal.SetConfigOption('GDAL_PAM_ENABLED', 'YES')
+        ds = gdal.Open(out_file, gdal.GA_ReadOnly)
+        sr = osr.SpatialReference()
+        sr.ImportFromEPSG(4326)
+        ds.SetGCPs(_gcps((ds.RasterXSize, ds.RasterYSize), meta), sr.ExportToWkt())
+        ds = None
+        gdal.SetConfigOption('GDAL_PAM_ENABLED', pam)
+        
+        return opf_ref
     
-    '''
-    Enter the GCPs
-    Format: [map x-coordinate(longitude)], [map y-coordinate (latitude)], [elevation],
-    [image column index(x)], [image row index (y)]
-    If map pixel is negative, multiply it with -1 to make positive since GDAL can't handle negative pixel position that well.
-    
-    '''
-    
-    gcps = [gdal.GCP(meta[0][0], meta[0][1], 0, ext_pos[0][0], ext_pos[0][1]), 
-            gdal.GCP(meta[1][0], meta[1][1], 0, ext_pos[1][0], ext_pos[1][1]),
-            gdal.GCP(meta[2][0], meta[2][1], 0, ext_pos[2][0], ext_pos[2][1]), 
-            gdal.GCP(meta[3][0], meta[3][1], 0, ext_pos[3][0], ext_pos[3][1])]
+    band_tif = gdal.Open(inp_file)
+    gcps = _gcps((band_tif.RasterXSize, band_tif.RasterYSize), meta)
+    dtype = band_tif.GetRasterBand(1).DataType
     
-    ds.SetGCPs(gcps, sr.ExportToWkt())
-    ds = None
+    if vrt:
+        gdal.Translate(os.path.splitext(out_file)[0] + '.vrt', band_tif, format = 'VRT', GCPs = gcps, outputSRS = 'EPSG:4326')
+    else:
+        gdal.Translate(out_file, band_tif, format = 'GTiff', GCPs = gcps, outputSRS = 'EPSG:4326',
+                       creationOptions = _gtiff_options(dtype = dtype))
+    band_tif = None
     
     return opf_ref
 
 
-def calc_toa(rad, sun_elev, band_no):
+@lru_cache(maxsize = 8)
+def _scale(sun_elev):
+
+    """
+    This function returns the radiance to top of atmosphere reflectance factors of all the bands. Cached per sun elevation.
+
+    Parameters:
+        sun_elev (float): Sun elevation angle (degrees).
+
+    Returns:
+        k (numpy array): Read-only float32 array with one scale factor per band.
+
+    """
+
+    k = ((np.pi * 10) / (ESOL * 1000 * math.sin(math.radians(sun_elev)))).astype('float32')
+    k.flags.writeable = False
+    return k
+
+
+def _toa_scale(sun_elev, band_no):
+
+    """
+    This function returns the factor that converts radiance to top of atmosphere reflectance.
+
+    Parameters:
+        sun_elev (float): Sun elevation angle.
+        band_no (int or list): Band number, or the N band numbers of a stack.
+
+    Returns:
+        k (float or numpy array): Scale factor. Shaped (N, 1, 1) for a stack of bands.
+
+    """
+
+    k = _scale(sun_elev)[band_no]
+    if np.ndim(k):
+        k = k.reshape(-1, 1, 1)
+    return k
+
+
+if njit is not None:
+    def _toa_loop(rad, k, out):
+        
+        """
+        Scales a 2-D radiance array by `k` and sets values outside [0, 2] to 0 in a single pass.
+        """
+        
+        H, W = rad.shape
+        for i in prange(H):
+            for j in range(W):
+                v = rad[i, j] * k
+                if v < 0.0 or v > 2.0:
+                    v = 0.0
+                out[i, j] = v
+        return out
+    
+    # `fastmath` without 'nnan', so that NaN radiance stays NaN as in the NumPy and numexpr paths.
+    # Pool workers use the serial build (see `_init_worker`): a forked child must not start numba's threading layer
+    # once the parent has run the parallel one, or it hangs.
+    _toa_kernel = njit(parallel = True, fastmath = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache = True)(_toa_loop)
+    _toa_kernel_serial = njit(fastmath = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'})(_toa_loop)
+else:
+    _toa_kernel = _toa_kernel_serial = None
+
+
+def calc_toa(rad, sun_elev, band_no, out = None):
 
     """
     This function calculates the top of atmosphere reflectance.
 
     Parameters:
-        rad (numpy array): Array containing the radiance values.
+        rad (numpy array): Array containing the radiance values. Either a single band (H, W) or a stack of bands (N, H, W).
         sun_elev (float): Sun elevation angle.
-        band_no (int): Band number.
+        band_no (int or list): Band number, or the N band numbers of a stack.
+        out (numpy array): Array the result is written to. If None, a float `rad` is converted in place and
+            a new float32 array is allocated for integer input. Default is None.
 
     Returns:
         toa_reflectance (numpy array): Array containing the top of atmosphere reflectance values.
 
     """
 
-    esol = [1.72815, 1.85211, 1.9721, 1.86697, 1.82781, 1.65765, 1.2897, 0.952073]
-    toa_reflectance = (np.pi * 1 * rad * 10) / (esol[band_no] * 1000 * math.sin(math.radians(sun_elev)))
+    if out is None:
+        out = rad if rad.dtype.kind == 'f' else np.empty(rad.shape, dtype = 'float32')
+    k = _toa_scale(sun_elev, band_no)
+    toa_reflectance = np.multiply(rad, k, out = out)
     return toa_reflectance
 
-def toa_convert(inpf, inp_name, opf, sun_elev):
+def _toa_band(rad, sun_elev, band_no):
 
     """
-    This function converts the radiance values to top of atmosphere reflectance values.
+    This function converts radiance to top of atmosphere reflectance and sets values outside [0, 2] to 0.
+    Float input is converted in place. Integer input is first copied to float32, whatever the backend.
 
     Parameters:
-        inpf (str): Path to the folder containing the GeoTiff files.
-        inp_name (str): Name of the GeoTiff file.
-        opf (str): Path to the folder containing the output GeoTiff files.
+        rad (numpy array): Array containing the radiance values. Either a single band or a stack of bands.
         sun_elev (float): Sun elevation angle.
+        band_no (int or list): Band number, or the band numbers of a stack.
 
     Returns:
-        opf (str): Path to the folder containing the output GeoTiff files.
+        toa (numpy array): Array containing the top of atmosphere reflectance values.
 
     """
+
+    if rad.dtype.kind != 'f':
+        rad = rad.astype('float32')
     
-    band_no = int(''.join(list(filter(str.isdigit, inp_name.split('.')[0].split('_')[0]))))
-    with rasterio.open(os.path.join(inpf, inp_name)) as (r):
-        rad = r.read(1).astype('float32')
-        profile = r.profile
+    if _toa_kernel is not None or ne is not None:
+        k = _toa_scale(sun_elev, band_no)
+        for band, kb in zip(rad[np.newaxis] if rad.ndim == 2 else rad, np.ravel(k)):
+            if _toa_kernel is not None:
+                _toa_kernel(band, np.float32(kb), band)
+            else:
+                ne.evaluate('where((band * kb < 0) | (band * kb > 2), 0, band * kb)',
+                            local_dict = {'band': band, 'kb': np.float32(kb)}, out = band, casting = 'same_kind')
+        return rad
     
     toa = calc_toa(rad, sun_elev, band_no)
-    toa[toa < 0] = 0.0
-    toa[toa > 2] = 0.0   
-    op_name = os.path.basename(inp_name).split('.')[0] + '.TIF'
-    with (rasterio.open)((os.path.join(opf, op_name)), 'w', **profile) as (dataset):
-        dataset.write(toa, 1)
-    dataset.close()
-        
-    return opf
+    toa[toa > 2] = 0.0
+    np.maximum(toa, 0.0, out = toa)
+    return toa
 
-def list_files(inpf, inp_name, files):
+def toa_convert(inpf, inp_name, opf, sun_elev, meta = None):
 
     """
-    This function lists the GeoTiff files.
+    This function converts the radiance values to top of atmosphere reflectance values.
 
     Parameters:
         inpf (str): Path to the folder containing the GeoTiff files.
         inp_name (str): Name of the GeoTiff file.
-        files (list): List containing the GeoTiff files. Empty list at the beginning.
+        opf (str): Path to the folder containing the output GeoTiff files.
+        sun_elev (float): Sun elevation angle.
+        meta (list): List containing the metadata of the HDF file. If given, the output is written georeferenced
+            (GCPs in EPSG:4326) and named `<band>_georef.TIF`, so no separate `Georeference` pass is needed. Default is None.
 
     Returns:
-        files (list): List containing the GeoTiff files.
+        opf (str): Path to the folder containing the output GeoTiff files.
 
     """
     
-    files.append(os.path.join(inpf, inp_name))
-    return files
+    band_no = _band_no(inp_name)
+    if band_no is None:
+        raise ValueError('stopping, no band number in file name {}'.format(inp_name))
+    op_name = os.path.basename(inp_name).split('.')[0] + '.TIF'
+    with rasterio.open(os.path.join(inpf, inp_name)) as (r):
+        profile = r.profile
+        profile.update(_rio_options())
+        if meta is not None:
+            profile.pop('transform', None)
+            profile.update(crs = 'EPSG:4326', gcps = _rio_gcps((r.width, r.height), meta))
+            op_name = os.path.basename(inp_name).split('.')[0] + '_georef.TIF'
         
-    
+        # One float32 tile buffer is reused for every 512 x 512 window instead of materializing the whole band.
+        # Every band of a multi-band file is converted, as in `_process_subdataset`.
+        buf = np.empty(512 * 512, dtype = 'float32')
+        with (rasterio.open)((os.path.join(opf, op_name)), 'w', **profile) as (dataset):
+            for xoff, yoff, xsize, ysize in _tiles(r.width, r.height):
+                window = Window(xoff, yoff, xsize, ysize)
+                for j in range(1, r.count + 1):
+                    rad = r.read(j, window = window, out = buf[:xsize * ysize].reshape(ysize, xsize), out_dtype = 'float32')
+                    dataset.write(_toa_band(rad, sun_elev, band_no), j, window = window)
+        
+    return opf
+
 def sum_toa(filelist):
 
     """
@@ -242,13 +612,16 @@ def sum_toa(filelist):
     """
     
     with rasterio.open(filelist[0]) as r:
-        arr = r.read()
-        profile = r.profile
-        
+        arr = r.read(out_dtype = 'float32')
+    
+    # One accumulator and one read buffer are reused for all the bands.
+    # Only the shape matters for the sum, so it is checked instead of the whole profile.
+    tmp = np.empty_like(arr)
     for f in filelist[1:]:
         with rasterio.open(f) as r:
-            assert profile == r.profile, 'stopping, file {} and  {} do not have matching profiles'.format(filelist[0], f)
-            arr = arr + r.read()
+            if (r.count, r.height, r.width) != arr.shape:
+                raise ValueError('stopping, file {} and  {} do not have matching shapes'.format(filelist[0], f))
+            arr += r.read(out = tmp, out_dtype = 'float32')
 
     return (arr)
 
@@ -280,14 +653,77 @@ def toa_other(filelist):
         band7 = r.read()
         
     
-    band2[band2 == 0.0] = np.nan
-    band7[band7 == 0.0] = np.nan
+    # Zero reflectance in band 2 or band 7 is no data and gives NaN.
+    if ne is not None:
+        local_dict = {'b1': band1, 'b2': band2, 'b7': band7, 'nan': np.float32(np.nan)}
+        toa_diff = ne.evaluate('where(b2 == 0, nan, b2 - b1)', local_dict = local_dict)
+        toa_ratio = ne.evaluate('where((b2 == 0) | (b7 == 0), nan, b2 / b7)', local_dict = local_dict)
+    else:
+        band2[band2 == 0.0] = np.nan
+        band7[band7 == 0.0] = np.nan
 
-    toa_diff = band2 - band1
-    toa_ratio = band2/band7 
+        toa_diff = band2 - band1
+        toa_ratio = band2/band7 
 
     return (toa_diff, toa_ratio, shape, profile)
 
+def _cloud_mask(toa_sum, band1, band2, band7):
+
+    """
+    This function applies the cloud mask thresholds of Mishra et al. (2018) to in-memory reflectance arrays.
+
+    Parameters:
+        toa_sum (numpy array): Sum of the top of atmosphere reflectance of bands 1-8.
+        band1 (numpy array): Top of atmosphere reflectance of band 1.
+        band2 (numpy array): Top of atmosphere reflectance of band 2.
+        band7 (numpy array): Top of atmosphere reflectance of band 7.
+
+    Returns:
+        cldmsk (numpy array): uint8 array containing the cloud mask (1 for cloud, 0 otherwise).
+
+    """
+
+    # Zero reflectance in band 2 or band 7 is treated as no data, as in `toa_other`.
+    # The predicates are combined as booleans and reinterpreted as bytes, so no float or int64 mask is materialized.
+    if ne is not None:
+        cldmsk = ne.evaluate('(s > 2.7) & (b2 != 0) & (b7 != 0) & (b2 / b7 > 1.5) & (b2 - b1 < 0)',
+                             local_dict = {'s': toa_sum, 'b1': band1, 'b2': band2, 'b7': band7})
+    else:
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            cldmsk = (toa_sum > 2.7) & (band2 != 0) & (band7 != 0) & (band2 / band7 > 1.5) & (band2 - band1 < 0)
+    
+    return cldmsk.view(np.uint8)
+
+def _cloud_mask_files(filelist):
+
+    """
+    This function computes the cloud mask from the reflectance files of bands 1-8, in 512 x 512 tiles so that only one
+    tile of each band is in memory at a time.
+
+    Parameters:
+        filelist (list): List of paths of the reflectance GeoTiff files, sorted by band number. The first band of each is used.
+
+    Returns:
+        cldmsk (numpy array): uint8 array containing the cloud mask (1 for cloud, 0 otherwise).
+
+    """
+
+    with rasterio.open(filelist[0]) as r:
+        width, height = r.width, r.height
+    
+    cldmsk = np.zeros((height, width), dtype = 'uint8')
+    buf = np.empty(len(filelist) * 512 * 512, dtype = 'float32')
+    with ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(f)) for f in filelist]
+        for xoff, yoff, xsize, ysize in _tiles(width, height):
+            window = Window(xoff, yoff, xsize, ysize)
+            tile = buf[:len(filelist) * xsize * ysize].reshape(len(filelist), ysize, xsize)
+            for i, src in enumerate(srcs):
+                src.read(1, window = window, out = tile[i], out_dtype = 'float32')
+            cldmsk[yoff:yoff + ysize, xoff:xoff + xsize] = _cloud_mask(tile.sum(axis = 0), tile[0], tile[1], tile[6])
+    
+    return cldmsk
+
 def cloudmask_ocm(inpf, filelist):
 
     """
@@ -302,20 +738,21 @@ def cloudmask_ocm(inpf, filelist):
 
     """
     
-    toa_sum = sum_toa(filelist)
-    toa_diff, toa_ratio, shape, profile = toa_other(filelist) 
+    with rasterio.open(filelist[0]) as r:
+        profile = r.profile
+    profile.pop('zstd_level', None)
+    profile.update(dtype = 'uint8', count = 1, nodata = 255, compress = 'deflate', predictor = 2, tiled = True,
+                   blockxsize = 512, blockysize = 512)
     
-    cldmsk = np.zeros(shape, dtype = 'float32')
-    cldmsk = np.where(((toa_sum > 2.7) & (toa_ratio > 1.5) & (toa_diff < 0)), 1, 0)
+    cldmsk = _cloud_mask_files(filelist)
     
     with (rasterio.open)((os.path.join(inpf, 'cloud_mask.TIF')), 'w', **profile) as (dst):
-        dst.write(cldmsk)
-    dst.close()
+        dst.write(cldmsk, 1)
     
     return cldmsk
 
 
-def do_ref(opf_tif, meta, opf_ref):
+def do_ref(opf_tif, meta, opf_ref, bands = None):
 
     """
     This function calls the function that creates the top of atmosphere reflectance GeoTiff files.
@@ -324,23 +761,54 @@ def do_ref(opf_tif, meta, opf_ref):
         opf_tif (str): Path to the folder containing the GeoTiff files.
         meta (list): List containing the metadata of the GeoTiff files.
         opf_ref (str): Path to the folder containing the output reflectance GeoTiff files. Temporary folder.
+        bands (list): List of (band number, file name) tuples of `opf_tif`. The folder is scanned if None. Default is None.
 
     Returns:
         None
 
     """
     
-    original = os.listdir(opf_tif)
-    gtif = list(filter(lambda x: x.endswith(("TIF", "tif", "img")), original))
-    for band_name in gtif:
-        if (int(''.join(list(filter(str.isdigit, band_name.split('.')[0].split('_')[0]))))) <= 7:
-            toa_convert(opf_tif, band_name, opf_ref, meta[4])
+    sun_elev = meta[4]
+    if bands is None:
+        bands = _list_bands(opf_tif)
+    
+    ref_bands, band_nos = [], []
+    for band_no, band_name in bands:
+        if band_no <= 7:
+            ref_bands.append(band_name)
+            band_nos.append(band_no)
         else:
             shutil.copy(os.path.join(opf_tif, band_name), os.path.join(opf_ref, band_name))
+    
+    if not ref_bands:
+        return None
+    
+    # All reflectance layers, every band of every file, are scaled and range-masked in one broadcast pass over a
+    # (N, 512, 512) stack per tile, so the working set is one tile per layer rather than the whole scene.
+    with ExitStack() as es:
+        srcs = [es.enter_context(rasterio.open(os.path.join(opf_tif, band_name))) for band_name in ref_bands]
+        dsts = []
+        for band_name, r in zip(ref_bands, srcs):
+            profile = r.profile
+            profile.update(_rio_options())
+            dsts.append(es.enter_context(rasterio.open(os.path.join(opf_ref, band_name), 'w', **profile)))
+        
+        counts = [r.count for r in srcs]
+        starts = np.cumsum([0] + counts)
+        layer_nos = np.repeat(band_nos, counts)
+        buf = np.empty(sum(counts) * 512 * 512, dtype = 'float32')
+        for xoff, yoff, xsize, ysize in _tiles(srcs[0].width, srcs[0].height):
+            window = Window(xoff, yoff, xsize, ysize)
+            stack = buf[:sum(counts) * xsize * ysize].reshape(sum(counts), ysize, xsize)
+            for r, start, count in zip(srcs, starts, counts):
+                r.read(out = stack[start:start + count], window = window, out_dtype = 'float32')
+            toa = _toa_band(stack, sun_elev, layer_nos)
+            for dataset, start, count in zip(dsts, starts, counts):
+                dataset.write(toa[start:start + count], window = window)
             
     return None
     
-def do_georef(opf_ref, meta, opf_georef):
+def do_georef(opf_ref, meta, opf_georef, sidecar = False, bands = None, vrt = False, workers = None):
 
     """
     This function calls the function that georeferences the top of atmosphere reflectance GeoTiff files.
@@ -349,85 +817,161 @@ def do_georef(opf_ref, meta, opf_georef):
         geo_ref (str): Path to the folder containing the georeferenced GeoTiff files.
         meta (list): List containing the metadata of the HDF files.
         opf_georef (str): Path to the folder containing the output georeferenced GeoTiff files. 
+        sidecar (bool): If True, GCPs are written to `.aux.xml` sidecars of hard-linked files. See `Georeference`. Default is False.
+        bands (list): List of (band number, file name) tuples of `opf_ref`, as returned by `_list_bands`. If None, every
+            GeoTiff file of the folder, including `cloud_mask.TIF`, is georeferenced. Default is None.
+        vrt (bool): If True, GCP-only VRT files are written instead of GeoTiff copies. See `Georeference`. Default is False.
+        workers (int): Number of worker processes. 1 georeferences the files in this process. See `_map`. Default is None.
 
     Returns:
         opf_georef (str): Path to the folder containing the output georeferenced GeoTiff files.
 
     """
     
-    original = os.listdir(opf_ref)
-    gtif = list(filter(lambda x: x.endswith(("TIF", "tif", "img")), original))
-    for band_name in gtif:
-        Georeference(opf_ref, band_name, meta, opf_georef)
+    if bands is not None:
+        gtif = [band_name for band_no, band_name in bands]
+    else:
+        with os.scandir(opf_ref) as it:
+            gtif = [e.name for e in it if e.is_file() and e.name.lower().endswith(('.tif', '.img'))]
+    _map(partial(Georeference, opf_ref, meta = meta, opf_ref = opf_georef, sidecar = sidecar, vrt = vrt), (gtif,), workers)
         
     return opf_georef
     
-def do_cldmsk(opf_ref):
+def do_cldmsk(opf_ref, bands = None):
 
     """
     This function calls the function that creates the cloud mask.
 
     Parameters:
         opf_ref (str): Path to the folder containing the output georeferenced GeoTiff files.
+        bands (list): List of (band number, file name) tuples of `opf_ref`. The folder is scanned if None. Default is None.
 
     Returns:
         None
 
     """
     
-    files = []
-
-    original = os.listdir(opf_ref)
-    gtif = list(filter(lambda x: x.endswith(("TIF", "tif", "img")), original))
-    for band_name in gtif:
-        if (int(''.join(list(filter(str.isdigit, band_name.split('.')[0].split('_')[0]))))) <= 7:
-            filelist = list_files(opf_ref, band_name, files)
+    # Sorted by band number, so band 1, 2 and 7 are at the indices `cloudmask_ocm` expects.
+    if bands is None:
+        bands = _list_bands(opf_ref)
+    filelist = [os.path.join(opf_ref, band_name) for band_no, band_name in bands if band_no <= 7]
 
     cldmsk = cloudmask_ocm(opf_ref, filelist)
     
     return None
 
-def run_ocm2(path, hdf_file):
+def _process_subdataset(subdataset_name, band_no, out_file, meta, sun_elev, compress = 'ZSTD'):
+
+    """
+    This function exports, converts to reflectance (bands 0-7) and georeferences a single HDF subdataset in one pass.
+    Worker of `run_ocm2`.
+
+    Parameters:
+        subdataset_name (str): GDAL name of the subdataset.
+        band_no (int): Band number.
+        out_file (str): Path of the output georeferenced GeoTIFF file.
+        meta (list): List containing the metadata of the HDF file.
+        sun_elev (float): Sun elevation angle.
+        compress (str): Compression codec of the GeoTIFF file.
+
+    Returns:
+        out_file (str): Path of the output georeferenced GeoTIFF file.
+
+    """
+
+    band_ds = gdal.Open(subdataset_name, gdal.GA_ReadOnly)
+    gcps = _gcps((band_ds.RasterXSize, band_ds.RasterYSize), meta)
+    nodata = band_ds.GetRasterBand(1).GetNoDataValue()
+    
+    if band_no <= 7:
+        sr = osr.SpatialReference()
+        sr.ImportFromEPSG(4326)
+        out_ds = gdal.GetDriverByName('GTiff').Create(out_file,
+                                                      band_ds.RasterXSize,
+                                                      band_ds.RasterYSize,
+                                                      band_ds.RasterCount,
+                                                      gdal.GDT_Float32,
+                                                      _gtiff_options(compress))
+        out_ds.SetGCPs(gcps, sr.ExportToWkt())
+        
+        # Every band of the subdataset is converted, each read exactly once.
+        # Tiles match the output GeoTIFF blocks, so the working set is a single tile and every write fills whole blocks.
+        for j in range(1, band_ds.RasterCount + 1):
+            band, out_band = band_ds.GetRasterBand(j), out_ds.GetRasterBand(j)
+            if nodata is not None:
+                out_band.SetNoDataValue(nodata)
+            for xoff, yoff, xsize, ysize in _tiles(band_ds.RasterXSize, band_ds.RasterYSize):
+                rad = band.ReadAsArray(xoff, yoff, xsize, ysize, buf_type = gdal.GDT_Float32)
+                out_band.WriteArray(_toa_band(rad, sun_elev, band_no), xoff, yoff)
+        out_ds.BuildOverviews('AVERAGE', [2, 4, 8, 16])
+    else:
+        dtype = band_ds.GetRasterBand(1).DataType
+        out_ds = gdal.Translate(out_file, band_ds, format = 'GTiff',
+                                bandList = list(range(1, band_ds.RasterCount + 1)),
+                                noData = nodata,
+                                GCPs = gcps, outputSRS = 'EPSG:4326',
+                                creationOptions = _gtiff_options(compress, dtype))
+        out_ds.BuildOverviews('NEAREST', [2, 4, 8, 16])
+    out_ds = None
+    band_ds = None
+    
+    return out_file
+
+def run_ocm2(path, hdf_file, compress = 'ZSTD', workers = None):
 
     """
     This is the main function of the script. It calls all the other functions. 
+    Each subdataset is read once from the HDF file and written once as georeferenced ToA reflectance. The cloud mask is
+    then computed from the reflectance files in tiles.
+    The subdatasets are processed in a pool of worker processes. On Windows and macOS, and with Python 3.14+ everywhere,
+    a script must therefore call `run_ocm2` under `if __name__ == '__main__':`, or pass `workers = 1`.
 
     Parameters:
         path (str): Path to the folder containing the HDF files.
         hdf_file (str): Name of the HDF file.
+        compress (str): Compression codec of the output GeoTIFF files. One of 'ZSTD', 'DEFLATE' or 'LZW'.
+            The floating point predictor is used for the reflectance bands in every case. Default is 'ZSTD'.
+        workers (int): Number of worker processes. 1 processes the subdatasets in this process, without a pool.
+            Default is None, up to 8.
 
     Returns:
-        opf_georef (str): Path to folder containing georeferenced ToA reflectance files.
+        opf_georef (str): Path to folder containing georeferenced ToA reflectance files, with overviews, and `scene.vrt`,
+        a virtual stack of the reflectance bands.
 
     """
 
     meta = metaInfo(path, hdf_file)
-    opf_tif = ExportSubdatasets(path, hdf_file)
-    print('Done: Layers converted to GeoTIFF. Wait.')
-
-    opf_ref = os.path.join(path, 'Reflectance')
-    if os.path.exists(opf_ref):
-        shutil.rmtree(opf_ref)
-    os.makedirs(opf_ref)
+    sun_elev = meta[4]
 
     opf_georef = os.path.join(path, 'Georeferenced')
     if os.path.exists(opf_georef):
         shutil.rmtree(opf_georef)
     os.makedirs(opf_georef)
 
-    do_ref(opf_tif, meta, opf_ref)
-    print('Done: Reflectance conversion. Wait.')
-    
-    do_cldmsk(opf_ref)
-    print('Done: Cloudmasking. Wait.')
-    
-    opf_georef = do_georef(opf_ref, meta, opf_georef)
-    print('Done: Georeferncing')
+    hdf_ds = gdal.Open(os.path.join(path, hdf_file), gdal.GA_ReadOnly)
+    subdatasets = [sd[0] for sd in hdf_ds.GetSubDatasets()]
+    hdf_ds = None
+    out_files = [os.path.join(opf_georef, 'band{0}_georef.TIF'.format(i)) for i in range(0, len(subdatasets))]
 
-    if os.path.exists(opf_tif):
-        shutil.rmtree(opf_tif)
-        
-    if os.path.exists(opf_ref):
-        shutil.rmtree(opf_ref)
+    _map(partial(_process_subdataset, meta = meta, sun_elev = sun_elev, compress = compress),
+         (subdatasets, range(0, len(subdatasets)), out_files), workers)
+    print('Done: Reflectance conversion and georeferencing. Wait.')
+    
+    # The mask is computed tile by tile from the reflectance outputs, so no full band is held in memory or
+    # sent back from the workers.
+    cldmsk = _cloud_mask_files(out_files[:8])
+    height, width = cldmsk.shape
+    sr = osr.SpatialReference()
+    sr.ImportFromEPSG(4326)
+    mask_ds = gdal.GetDriverByName('GTiff').Create(os.path.join(opf_georef, 'cloud_mask_georef.TIF'),
+                                                   width, height, 1, gdal.GDT_Byte, _gtiff_options(compress, gdal.GDT_Byte))
+    mask_ds.SetGCPs(_gcps((width, height), meta), sr.ExportToWkt())
+    mask_ds.GetRasterBand(1).SetNoDataValue(255)
+    mask_ds.GetRasterBand(1).WriteArray(cldmsk)
+    mask_ds.BuildOverviews('NEAREST', [2, 4, 8, 16])
+    mask_ds = None
+    print('Done: Cloudmasking')
+
+    _build_vrt(os.path.join(opf_georef, 'scene.vrt'), out_files[:8])
 
     return opf_georef
@@ -3,8 +3,13 @@
 """Tests for `ocm2` package."""
 
 
+import os
+import tempfile
 import unittest
 
+import numpy as np
+import rasterio
+
 from ocm2 import ocm2
 
 
@@ -19,3 +24,94 @@ class TestOcm2(unittest.TestCase):
 
     def test_000_something(self):
         """Test something."""
+
+    def test_calc_toa_keeps_float32(self):
+        """The reflectance conversion stays in float32 and matches the reference formula."""
+        rad = np.full((4, 4), 100.0, dtype = 'float32')
+        toa = ocm2.calc_toa(rad.copy(), 60.0, 2)
+        expected = (np.pi * 100.0 * 10) / (1.9721 * 1000 * np.sin(np.radians(60.0)))
+        self.assertEqual(toa.dtype, np.float32)
+        np.testing.assert_allclose(toa, expected, rtol = 1e-6)
+
+    def test_toa_band_backends_agree(self):
+        """The numba, numexpr and NumPy paths give the same reflectance, including NaN, negative and > 2 values."""
+        rad = np.array([[np.nan, -10.0, 0.0, 50.0], [90.0, 95.0, 200.0, 1e6]], dtype = 'float32')
+        saved = ocm2._toa_kernel, ocm2.ne
+        try:
+            ocm2._toa_kernel, ocm2.ne = None, None
+            expected = ocm2._toa_band(rad.copy(), 60.0, 0)
+            backends = {'numba': (saved[0], None), 'numba serial': (ocm2._toa_kernel_serial, None),
+                        'numexpr': (None, saved[1])}
+            for name, (kernel, ne) in backends.items():
+                if kernel is None and ne is None:
+                    continue
+                ocm2._toa_kernel, ocm2.ne = kernel, ne
+                with self.subTest(backend = name):
+                    np.testing.assert_array_equal(ocm2._toa_band(rad.copy(), 60.0, 0), expected)
+        finally:
+            ocm2._toa_kernel, ocm2.ne = saved
+        self.assertTrue(np.isnan(expected[0, 0]))
+        self.assertEqual(expected[0, 1], 0.0)
+        self.assertEqual(expected[1, 2], 0.0)
+
+    def test_toa_band_integer_input(self):
+        """Integer radiance gives the same float32 reflectance as float input, whatever the backend."""
+        rad = np.array([[-10, 0, 50, 200]], dtype = 'int16')
+        toa = ocm2._toa_band(rad, 60.0, 3)
+        self.assertEqual(toa.dtype, np.float32)
+        np.testing.assert_array_equal(toa, ocm2._toa_band(rad.astype('float32'), 60.0, 3))
+        np.testing.assert_array_equal(rad, [[-10, 0, 50, 200]])
+
+    def _mask_bands(self):
+        """Bands 0-7 tiled over 600 x 600 pixels, with one cloud pixel in every six: a cloud, b2 == 0, b7 == 0,
+        a low sum, a low b2/b7 ratio and b2 > b1."""
+        bands = np.full((8, 1, 6), 0.5, dtype = 'float32')
+        bands[0, 0] = [0.6, 0.6, 0.6, 0.3, 0.6, 0.4]
+        bands[1, 0] = [0.5, 0.0, 0.5, 0.2, 0.5, 0.5]
+        bands[6, 0] = [0.2, 0.2, 0.0, 0.1, 0.4, 0.2]
+        bands[2:6, 0, 3] = bands[7, 0, 3] = 0.0
+        return np.tile(bands, (1, 600, 100))
+
+    def test_do_cldmsk_matches_reference(self):
+        """The tiled cloud mask of `do_cldmsk` matches the Mishra et al. (2018) thresholds on whole bands."""
+        bands = self._mask_bands()
+        b1, b2, b7 = bands[0], bands[1], bands[6]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            expected = (bands.sum(axis = 0) > 2.7) & (b2 != 0) & (b7 != 0) & (b2 / b7 > 1.5) & (b2 - b1 < 0)
+        np.testing.assert_array_equal(expected, np.tile([[True, False, False, False, False, False]], (600, 100)))
+        
+        with tempfile.TemporaryDirectory() as folder:
+            profile = dict(driver = 'GTiff', height = 600, width = 600, count = 1, dtype = 'float32')
+            # Written in reverse so that the band order cannot come from the directory order.
+            for band_no in reversed(range(8)):
+                with rasterio.open(os.path.join(folder, 'band{0}.TIF'.format(band_no)), 'w', **profile) as dst:
+                    dst.write(bands[band_no], 1)
+            ocm2.do_cldmsk(folder)
+            with rasterio.open(os.path.join(folder, 'cloud_mask.TIF')) as r:
+                self.assertEqual(r.dtypes[0], 'uint8')
+                np.testing.assert_array_equal(r.read(1), expected.astype('uint8'))
+
+    def test_cloud_mask_backends_agree(self):
+        """The numexpr and NumPy cloud masks agree."""
+        if ocm2.ne is None:
+            self.skipTest('numexpr is not installed')
+        bands = self._mask_bands()
+        args = (bands.sum(axis = 0), bands[0], bands[1], bands[6])
+        saved = ocm2.ne
+        try:
+            ocm2.ne = None
+            expected = ocm2._cloud_mask(*args)
+        finally:
+            ocm2.ne = saved
+        mask = ocm2._cloud_mask(*args)
+        self.assertEqual(mask.dtype, np.uint8)
+        np.testing.assert_array_equal(mask, expected)
+
+    def test_list_bands_sorted_by_band_number(self):
+        """Band files are sorted numerically, band10 after band2, and other files are skipped."""
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ['band10.TIF', 'band2.tif', 'band0.img', 'cloud_mask.TIF', 'band3.txt']:
+                open(os.path.join(folder, name), 'w').close()
+            self.assertEqual(ocm2._list_bands(folder), [(0, 'band0.img'), (2, 'band2.tif'), (10, 'band10.TIF')])
+        self.assertEqual(ocm2._band_no('band3_georef.TIF'), 3)
+        self.assertIsNone(ocm2._band_no('cloud_mask.TIF'))